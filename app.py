@@ -1,12 +1,17 @@
 import os
 import json
 import time
+import threading
 from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
 from functools import wraps
 from dotenv import load_dotenv
 from utils.db import init_db, connect, now, to_dict
 from utils.crypto import enc_str, dec_str
 from utils.binance import BinanceUM
+from utils.scheduler import ParentOrder, SliceScheduler, interrupt_stale
+from utils.payload import Payload, send
+from utils.actors import ActorRuntime, ASK_TIMEOUT
+from concurrent.futures import TimeoutError as FutureTimeout
 from cryptography.fernet import InvalidToken
 
 # --- NEW: JWT/SSO Imports ---
@@ -17,6 +22,7 @@ from werkzeug.wrappers import Response
 # --- Initialization ---
 load_dotenv()
 init_db()
+interrupt_stale()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', os.urandom(24))
 
@@ -61,13 +67,17 @@ def get_account(acc_id, user_id):
         cur.execute('SELECT * FROM accounts WHERE id=%s AND user_id=%s', (acc_id, user_id))
         return to_dict(cur.fetchone())
 
-def safe_get_client(acc):
+def safe_get_client(acc, **client_options):
     try:
         api_key = dec_str(acc['api_key_enc'])
         api_secret = dec_str(acc['api_secret_enc'])
     except InvalidToken:
         raise RuntimeError("Encryption key mismatch.")
-    return BinanceUM(api_key, api_secret, bool(acc['testnet']))
+    return BinanceUM(api_key, api_secret, bool(acc['testnet']), **client_options)
+
+actors = ActorRuntime(safe_get_client)
+# Sliced children and their unwinds run on the account's actor; the scheduler only keeps time.
+scheduler = SliceScheduler(actors.dispatch)
 
 def list_accounts(user_id):
     with connect() as con:
@@ -75,6 +85,64 @@ def list_accounts(user_id):
         cur.execute('SELECT * FROM accounts WHERE user_id=%s ORDER BY id DESC', (user_id,))
         return [to_dict(r) for r in cur.fetchall()]
 
+PUBLIC_ACCOUNT_FIELDS = ('id', 'name', 'exchange', 'testnet', 'active', 'futures_balance')
+
+def _public_accounts(accounts):
+    # Encrypted key blobs never leave the server.
+    return [{k: a.get(k) for k in PUBLIC_ACCOUNT_FIELDS} for a in accounts]
+
+SYMBOLS_TTL = 300 # Seconds before the USDT symbol list is rebuilt from exchangeInfo
+SYMBOLS_RETRY = 30 # Seconds a stale list is served after a failed rebuild
+_symbols_cache = {'payload': None, 'built_at': 0, 'refreshing': False}
+_symbols_ready = threading.Condition()
+
+def _symbols_payload():
+    with _symbols_ready:
+        # Cold start: wait for the request already building the first list instead of fetching again.
+        while _symbols_cache['payload'] is None and _symbols_cache['refreshing']:
+            _symbols_ready.wait()
+        cached = _symbols_cache['payload']
+        stale = cached is None or time.time() - _symbols_cache['built_at'] > SYMBOLS_TTL
+        refresh = stale and not _symbols_cache['refreshing']
+        if refresh: _symbols_cache['refreshing'] = True
+    # Only one request rebuilds; the rest keep serving the cached list meanwhile.
+    if not refresh: return cached
+    payload = None
+    try:
+        info = BinanceUM('', '', False).exchange_info()
+        symbols = [s['symbol'] for s in info.get('symbols', []) if s.get('quoteAsset') == 'USDT' and s.get('status') == 'TRADING']
+        payload = Payload({'symbols': symbols}).precompress()
+    except Exception as e:
+        if cached is None: raise
+        print(f"Symbol list refresh failed, serving cached copy: {e}")
+    finally:
+        with _symbols_ready:
+            if payload is not None: _symbols_cache.update(payload=payload, built_at=time.time())
+            elif cached is not None: _symbols_cache['built_at'] = time.time() - SYMBOLS_TTL + SYMBOLS_RETRY
+            _symbols_cache['refreshing'] = False
+            _symbols_ready.notify_all()
+    return payload or cached
+
+ROI_COLUMNS = ('symbol', 'side', 'entry_price', 'leverage', 'roi', 'mark_price')
+
+# Last columnar ROI payload per account, reused while the positions are unchanged.
+_roi_payloads = {}
+
+def _roi_payload(account_id, trades):
+    data = _roi_columns(trades)
+    last = _roi_payloads.get(account_id)
+    if last and last[0] == data: return last[1]
+    payload = Payload(data)
+    _roi_payloads[account_id] = (data, payload)
+    return payload
+
+def _roi_columns(trades):
+    # Columnar wire format: one array per field instead of a dict per position.
+    trades = sorted(trades, key=lambda t: (t['symbol'], t['side']))
+    data = [[t[c] for t in trades] for c in ROI_COLUMNS]
+    data[ROI_COLUMNS.index('roi')] = [round(r, 2) for r in data[ROI_COLUMNS.index('roi')]]
+    return {'ok': True, 'cols': ROI_COLUMNS, 'data': data}
+
 def _compute_roi(entry, mark, leverage, side):
     if not entry or entry <= 0: return 0.0
     roi = ((mark - entry) / entry) * leverage * 100
@@ -85,15 +153,14 @@ def _fetch_live_positions_and_roi(account_id, user_id):
     if not acc:
         raise RuntimeError("Account not found or you do not have permission.")
     
-    bn = safe_get_client(acc)
-    positions = bn.position_risk()
+    positions = actors.ask(acc, 'refresh')
     trades = []
 
     for p in positions:
         pos_amt = float(p.get('positionAmt', 0))
         if pos_amt != 0:
-            mark_price_data = bn.price(p['symbol'])
-            mark_price = float(mark_price_data.get('price', 0))
+            # positionRisk already carries the mark price, so no per-symbol ticker call is needed.
+            mark_price = float(p.get('markPrice', 0))
             entry_price = float(p.get('entryPrice', 0))
             side = p.get('positionSide')
             leverage = int(p.get('leverage', 1))
@@ -112,12 +179,21 @@ def _fetch_live_positions_and_roi(account_id, user_id):
 
 def _update_account_balances(user_id):
     accounts = list_accounts(user_id)
-    updated_list = []
+    pending = {}
     for acc in accounts:
         if acc['active'] and acc['id']:
             try:
-                bn = safe_get_client(acc)
-                latest_balance = bn.futures_balance()
+                pending[acc['id']] = actors.submit(acc, 'balance')
+            except Exception as e:
+                pending[acc['id']] = e
+    # Balances are fetched in parallel, one actor per account, under one shared deadline.
+    deadline = time.time() + ASK_TIMEOUT
+    updated_list = []
+    for acc in accounts:
+        if acc['id'] in pending:
+            try:
+                if isinstance(pending[acc['id']], Exception): raise pending[acc['id']]
+                latest_balance = pending[acc['id']].result(timeout=max(0.0, deadline - time.time()))
                 with connect() as con:
                     con.cursor().execute('UPDATE accounts SET futures_balance=%s, updated_at=%s WHERE id=%s AND user_id=%s', 
                                          (latest_balance, now(), acc['id'], user_id))
@@ -138,7 +214,7 @@ def home(user_id):
 @app.route('/account')
 @sso_required
 def account(user_id):
-    return render_template('account.html', accounts_json=json.dumps(list_accounts(user_id)))
+    return render_template('account.html', accounts_json=json.dumps(_public_accounts(list_accounts(user_id)), separators=(',', ':')))
 
 @app.route('/dashboard')
 @sso_required
@@ -165,15 +241,19 @@ def accounts_add(user_id):
         cur.execute('INSERT INTO accounts (name,exchange,api_key_enc,api_secret_enc,testnet,active,futures_balance,created_at,updated_at,user_id) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)',
                     (name, 'BINANCE_UM', enc_str(api_key), enc_str(api_secret), testnet, 1, balance, now(), now(), user_id))
         con.commit()
-    return jsonify({'ok': True, 'accounts': list_accounts(user_id)})
+    return jsonify({'ok': True, 'accounts': _public_accounts(list_accounts(user_id))})
 
 @app.route('/accounts/delete/<int:acc_id>', methods=['POST'])
 @sso_required
 def accounts_delete(acc_id, user_id):
     with connect() as con:
-        con.cursor().execute('DELETE FROM accounts WHERE id=%s AND user_id=%s', (acc_id, user_id))
+        cur = con.cursor()
+        cur.execute('DELETE FROM accounts WHERE id=%s AND user_id=%s', (acc_id, user_id))
         con.commit()
-    return jsonify({'ok': True, 'accounts': list_accounts(user_id)})
+    if cur.rowcount:
+        scheduler.cancel_account(acc_id)
+        actors.evict(acc_id)
+    return jsonify({'ok': True, 'accounts': _public_accounts(list_accounts(user_id))})
 
 @app.route('/accounts/toggle/<int:acc_id>', methods=['POST'])
 @sso_required
@@ -186,6 +266,7 @@ def accounts_toggle(acc_id, user_id):
             new_status = 1 if r['active'] == 0 else 0
             cur.execute('UPDATE accounts SET active=%s, updated_at=%s WHERE id=%s AND user_id=%s', (new_status, now(), acc_id, user_id))
             con.commit()
+            if not new_status: actors.evict(acc_id)
             return jsonify({'ok': True, 'status': new_status})
         return jsonify({'error': 'Account not found'}), 404
 
@@ -194,7 +275,7 @@ def accounts_toggle(acc_id, user_id):
 def accounts_update_balances(user_id):
     try:
         updated_accounts = _update_account_balances(user_id)
-        return jsonify({'ok': True, 'accounts': updated_accounts})
+        return jsonify({'ok': True, 'accounts': _public_accounts(updated_accounts)})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -241,10 +322,15 @@ def tpl_delete(tpl_id, user_id):
 def trades_fetch_roi(account_id, user_id):
     try:
         trades = _fetch_live_positions_and_roi(account_id, user_id)
+        if request.args.get('fmt') == 'cols':
+            # Per-tick feed: small and short-lived, so it is sent uncompressed.
+            return send(_roi_payload(account_id, trades), compress=False)
         return jsonify({'ok': True, 'trades': trades})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+EXEC_MODES = ('market', 'twap', 'pov')
+
 @app.route('/api/trades/submit', methods=['POST'])
 @sso_required
 def trades_submit(user_id):
@@ -255,44 +341,97 @@ def trades_submit(user_id):
     acc = get_account(account_id, user_id)
     if not acc or not acc['active']: return jsonify({'error': 'Account is not active or not yours'}), 400
     
+    execution = data.get('execution') or {}
+    if execution.get('mode', 'market') not in EXEC_MODES: return jsonify({'error': 'Unknown execution mode.'}), 400
     try:
-        bn = safe_get_client(acc)
+        if execution.get('mode', 'market') in ('twap', 'pov'):
+            return _submit_sliced(user_id, acc, bot_name, coins, execution)
+        fut = actors.submit(acc, 'open', coins)
     except RuntimeError as e: return jsonify({'error': str(e)}), 400
 
-    successful_trades = []
     try:
-        for coin in coins:
-            symbol, side, leverage, amount_usdt, margin_type = coin['symbol'], coin['side'].upper(), int(coin['leverage']), float(coin['margin']), coin['margin_mode'].upper()
-            bn.set_leverage(symbol, leverage)
-            bn.set_margin_type(symbol, margin_type)
-            price = float(bn.price(symbol)['price'])
-            qty = bn.round_lot_size(symbol, amount_usdt / price)
-            order_side = 'BUY' if side == 'LONG' else 'SELL'
-            bn.order_market(symbol, order_side, qty, position_side=side)
-            successful_trades.append({'symbol': symbol, 'side': side})
-            time.sleep(0.1)
+        # The actor rolls back already-filled legs before re-raising.
+        submitted = fut.result(timeout=ASK_TIMEOUT)
+    except FutureTimeout:
+        return _still_executing(fut, 'Orders are still being placed. Check running trades before resubmitting.')
     except Exception as e:
-        if successful_trades:
-            print(f"Rolling back {len(successful_trades)} trades...")
-            for trade in successful_trades:
-                try:
-                    cleanup_side = 'SELL' if trade['side'] == 'LONG' else 'BUY'
-                    pos_risk = bn.position_risk(trade['symbol'])
-                    for p in pos_risk:
-                        if p.get('positionSide') == trade['side']:
-                            amt = abs(float(p.get('positionAmt', 0)))
-                            if amt > 0: bn.order_market(trade['symbol'], cleanup_side, amt, position_side=trade['side'])
-                            break
-                except Exception as cleanup_e: print(f"Failed to rollback {trade['symbol']}: {cleanup_e}")
         return jsonify({'error': f"Failed to place order: {str(e)}"}), 500
     
     time.sleep(1.5) 
-    return jsonify({'ok': True, 'message': f"{len(successful_trades)} trades submitted."})
+    return jsonify({'ok': True, 'message': f"{submitted} trades submitted."})
+
+def _still_executing(fut, message):
+    """Answers a request whose actor command outlived ASK_TIMEOUT without reporting it as failed."""
+    if fut.cancel(): return jsonify({'error': 'Account is busy; the request was not started.'}), 503
+    return jsonify({'ok': True, 'pending': True, 'message': message}), 202
+
+def _submit_sliced(user_id, acc, bot_name, coins, execution):
+    """Queues each basket leg on the shared slice scheduler instead of sending one market order per coin."""
+    mode = execution['mode']
+    try:
+        slices = max(1, int(execution.get('slices', 10)))
+        interval = max(1.0, float(execution.get('interval', 30)))
+        participation = min(1.0, max(0.01, float(execution.get('participation', 0.1))))
+        max_duration = max(interval, float(execution.get('max_duration', 3600)))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid execution settings.'}), 400
+
+    legs = []
+    try:
+        # Leverage, margin type, price and filters come from the account's actor; nothing is ordered yet.
+        for leg in actors.ask(acc, 'prepare', coins):
+            symbol, lot, min_notional, price = leg['symbol'], leg['lot'], leg['min_notional'], leg['price']
+            if not lot: raise RuntimeError(f"No LOT_SIZE filter for {symbol}")
+            qty = leg['margin'] / price
+            # Every child must clear both minQty and MIN_NOTIONAL on its own.
+            min_qty = max(lot['minQty'], (min_notional or 0) / price)
+            parent = ParentOrder(acc=acc, symbol=symbol, side=leg['side'], quantity=qty, step=lot['stepSize'], min_qty=min_qty, mode=mode,
+                                 slices=slices, interval=interval, participation=participation, max_duration=max_duration)
+            if parent.quantity < min_qty or (mode == 'twap' and not parent.children):
+                raise RuntimeError(f"{symbol} order is below the exchange minimum size")
+            legs.append((parent, leg['leverage'], leg['margin'], leg['margin_type'], price))
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f"Failed to prepare order: {str(e)}"}), 500
+
+    with connect() as con:
+        cur = con.cursor()
+        cur.execute('INSERT INTO bots (name,account_id,symbols_str,side,leverage,margin_amount,margin_type,status,created_at,user_id) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)',
+                    (bot_name, acc['id'], ','.join(p.symbol for p, *_ in legs), legs[0][0].side, legs[0][1], sum(l[2] for l in legs), legs[0][3], 'Executing', now(), user_id))
+        bot_id = cur.lastrowid
+        for parent, leverage, amount_usdt, _, price in legs:
+            cur.execute('INSERT INTO trades (bot_id,symbol,side,leverage,margin_amount,entry_price,status,exec_mode,quantity,filled_qty,slices_total,slices_done,updated_at,user_id) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)',
+                        (bot_id, parent.symbol, parent.side, leverage, amount_usdt, price, 'Executing', mode, parent.quantity, 0, parent.slices_total, 0, now(), user_id))
+            parent.trade_id, parent.bot_id = cur.lastrowid, bot_id
+        con.commit()
+
+    scheduler.submit([p for p, *_ in legs])
+    return jsonify({'ok': True, 'bot_id': bot_id, 'message': f"{len(legs)} trades scheduled ({mode.upper()})."})
+
+@app.route('/api/trades/progress/<int:bot_id>', methods=['GET'])
+@sso_required
+def trades_progress(bot_id, user_id):
+    with connect() as con:
+        cur = con.cursor()
+        cur.execute('SELECT id, symbol, side, status, exec_mode, quantity, filled_qty, slices_total, slices_done, updated_at FROM trades WHERE bot_id=%s AND user_id=%s', (bot_id, user_id))
+        items = [to_dict(r) for r in cur.fetchall()]
+    if not items: return jsonify({'error': 'Bot not found'}), 404
+    return jsonify({'ok': True, 'items': items})
+
+@app.route('/api/trades/cancel/<int:bot_id>', methods=['POST'])
+@sso_required
+def trades_cancel(bot_id, user_id):
+    with connect() as con:
+        cur = con.cursor()
+        cur.execute('SELECT id FROM bots WHERE id=%s AND user_id=%s', (bot_id, user_id))
+        if not cur.fetchone(): return jsonify({'error': 'Bot not found'}), 404
+    return jsonify({'ok': True, 'cancelled': scheduler.cancel(bot_id)})
 
 @app.route('/api/trades/close', methods=['POST'])
 @sso_required
 def trades_close(user_id):
-    data, closed_count = request.get_json(force=True), 0
+    data = request.get_json(force=True)
     account_id, trades_to_close = data.get('account_id'), data.get('trades', [])
     if not account_id or not trades_to_close: return jsonify({'error': 'Account and trades list required'}), 400
 
@@ -300,25 +439,20 @@ def trades_close(user_id):
     if not acc:
         return jsonify({'error': 'Account not found or does not belong to you'}), 403
         
+    # Stop TWAP/POV baskets working these legs first so no later child reopens what is being closed.
+    legs = {(t.get('symbol'), str(t.get('side', '')).upper()) for t in trades_to_close}
+    scheduler.cancel_account(acc['id'], legs)
     try:
-        bn = safe_get_client(acc)
+        fut = actors.submit(acc, 'close', trades_to_close)
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
-    for trade in trades_to_close:
-        try:
-            symbol, side = trade['symbol'], trade['side'].upper()
-            close_side = 'SELL' if side == 'LONG' else 'BUY'
-            
-            pos_risk = bn.position_risk(symbol)
-            for p in pos_risk:
-                pos_amt = float(p.get('positionAmt', 0))
-                if p.get('positionSide') == side and pos_amt != 0:
-                    bn.order_market(symbol, close_side, abs(pos_amt), position_side=side)
-                    closed_count += 1
-                    break
-        except Exception as e:
-            print(f"Could not close trade for {trade.get('symbol')}: {e}")
+    try:
+        closed_count = fut.result(timeout=ASK_TIMEOUT)
+    except FutureTimeout:
+        return _still_executing(fut, 'Close orders are still being placed. Check running trades before retrying.')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
     time.sleep(1.5)
     return jsonify({'ok': True, 'message': f"Attempted to close {len(trades_to_close)} trades. {closed_count} confirmed."})
@@ -338,10 +472,7 @@ def symbol_info(user_id):
 @sso_required
 def futures_symbols(user_id):
     try:
-        bn = BinanceUM('', '', False)
-        info = bn.exchange_info()
-        symbols = [s['symbol'] for s in info.get('symbols', []) if s.get('quoteAsset') == 'USDT' and s.get('status') == 'TRADING']
-        return jsonify({'symbols': symbols})
+        return send(_symbols_payload(), cache_control='private, max-age=60')
     except Exception as e: return jsonify({'symbols': [], 'error': str(e)}), 500
 
 @app.route('/api/price')
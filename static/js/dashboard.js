@@ -96,6 +96,20 @@
     if (countEl) countEl.textContent = selectedCoins.size;
   }
   
+  // Columnar ROI feed: { cols: [...], data: [[...col0], [...col1], ...] } -> array of trade objects
+  function decodeColumns(d) {
+    const cols = d.cols || [];
+    const data = d.data || [];
+    const n = data.length ? data[0].length : 0;
+    const rows = [];
+    for (let i = 0; i < n; i++) {
+      const row = {};
+      cols.forEach((c, j) => (row[c] = data[j][i]));
+      rows.push(row);
+    }
+    return rows;
+  }
+
   // --- NEW POLLING LOGIC ---
   async function fetchAndUpdateTrades(accountId) {
     const s = document.getElementById('ws_status');
@@ -104,13 +118,14 @@
     if (s) { s.className = 'status-ok'; s.textContent = 'Live (Polling)'; } // Status indicator set to live during fetch
 
     try {
-        const r = await fetch(`/api/trades/fetch_roi/${accountId}`);
+        // The browser revalidates with If-None-Match and reuses its cached body on 304.
+        const r = await fetch(`/api/trades/fetch_roi/${accountId}?fmt=cols`);
         const data = await r.json();
 
         if (r.ok && data.ok) {
             runningTrades.clear();
-            if (data.trades) {
-                data.trades.forEach((trade) => {
+            if (data.data) {
+                decodeColumns(data).forEach((trade) => {
                     // Trades now include ROI and mark_price directly from the backend
                     runningTrades.set(trade.symbol, trade);
                 });
@@ -0,0 +1,338 @@
+import heapq, inspect, itertools, os, queue, threading, time
+from collections import deque
+from concurrent.futures import Future
+from utils.scheduler import RateBudget, klines_volume, unwind_side
+
+WORKERS = int(os.environ.get('ACTOR_WORKERS', 8))
+# Exchange calls per second one account may spend (Binance UM weight limit is 2400 / minute).
+ACCOUNT_RATE = 10.0
+ACCOUNT_BURST = 20
+# A refresh younger than this is answered from the position book without calling the exchange.
+BOOK_MAX_AGE = 0.5
+# Steps (exchange calls or pauses) one actor runs before yielding its worker to other accounts.
+BATCH_STEPS = 16
+# Idle actors (and their clients) are dropped after this many seconds.
+IDLE_TTL = 600
+ASK_TIMEOUT = 60
+# Actor clients fail fast rather than holding a shared worker through long retry loops.
+CLIENT_OPTIONS = {'retries': 2, 'retry_delay': 1, 'timeout': 10}
+
+def call(fn, *args, **kwargs):
+    """An exchange call yielded by a command handler; the actor runs it once the budget allows."""
+    return (fn, args, kwargs)
+
+class _Raised:
+    def __init__(self, error): self.error = error
+
+class AccountActor:
+    """
+    Owns one account's client, position book and rate-limit budget. Commands arrive
+    through the mailbox and are handled by at most one worker at a time, so exchange
+    access for the account is serialized without locking the client.
+
+    Handlers are generators that yield each exchange call (or a pause in seconds).
+    When the budget is short or a pause is requested the actor is parked on the
+    runtime's timer instead of sleeping, and its worker moves on to other accounts.
+    """
+    def __init__(self, runtime, acc_id, fingerprint, client):
+        self.runtime, self.acc_id, self.fingerprint = runtime, acc_id, fingerprint
+        self.bn = client
+        self.budget = RateBudget(ACCOUNT_RATE, ACCOUNT_BURST)
+        self.book, self.book_at = [], 0.0
+        self.mailbox = deque()
+        self.last_used = time.time()
+        self.evicted = False
+        self._scheduled = False
+        self._lock = threading.Lock()
+        # Command in progress: (generator, futures), the call waiting on the budget and the value to send back.
+        self._task, self._pending, self._reply = None, None, None
+
+    def ask(self, kind, arg=None):
+        """Queues a command and returns a Future for its result."""
+        fut = Future()
+        with self._lock:
+            self.mailbox.append((kind, arg, fut))
+            self.last_used = time.time()
+            wake = not self._scheduled
+            self._scheduled = True
+        if wake: self.runtime._ready.put(self)
+        return fut
+
+    def idle(self):
+        with self._lock:
+            return not self._scheduled and not self.mailbox
+
+    def _drain(self):
+        for _ in range(BATCH_STEPS):
+            if self._task is None:
+                if not self._start_next(): break
+                # Plain (non-generator) commands settle inside _start_next.
+                if self._task is None: continue
+            park = self._step()
+            if park is not None:
+                self.runtime._wake_at(self, park)
+                return
+        with self._lock:
+            if self.mailbox or self._task: self.runtime._ready.put(self)
+            else: self._scheduled = False
+
+    def _start_next(self):
+        with self._lock:
+            if not self.mailbox: return False
+            kind, arg, fut = self.mailbox.popleft()
+            cmds = [(arg, fut)]
+            # A run of adjacent refreshes shares a single exchange call.
+            while kind == 'refresh' and self.mailbox and self.mailbox[0][0] == 'refresh':
+                cmds.append(self.mailbox.popleft()[1:])
+        # Commands whose caller already cancelled them are dropped unrun.
+        futs = [f for _, f in cmds if f.set_running_or_notify_cancel()]
+        if not futs: return True
+        try:
+            result = self._handlers[kind](self, arg)
+        except Exception as e:
+            self._settle(futs, None, e)
+            return True
+        if inspect.isgenerator(result):
+            self._task, self._pending, self._reply = (result, futs), None, None
+        else:
+            self._settle(futs, result, None)
+        return True
+
+    def _step(self):
+        """Advances the current command by one call. Returns seconds to park for, or None to keep going."""
+        gen, futs = self._task
+        if self._pending is None:
+            reply, self._reply = self._reply, None
+            try:
+                req = gen.throw(reply.error) if isinstance(reply, _Raised) else gen.send(reply)
+            except StopIteration as stop:
+                self._task = None
+                self._settle(futs, stop.value, None)
+                return None
+            except Exception as e:
+                self._task = None
+                self._settle(futs, None, e)
+                return None
+            if not isinstance(req, tuple): return float(req)
+            self._pending = req
+        wait = self.budget.take()
+        if wait: return wait
+        fn, args, kwargs = self._pending
+        self._pending = None
+        try:
+            self._reply = fn(*args, **kwargs)
+        except Exception as e:
+            self._reply = _Raised(e)
+        return None
+
+    def _settle(self, futs, result, error):
+        for fut in futs:
+            if error is not None: fut.set_exception(error)
+            else: fut.set_result(result)
+
+    def _refresh(self, _=None):
+        if time.time() - self.book_at > BOOK_MAX_AGE:
+            self.book = yield call(self.bn.position_risk)
+            self.book_at = time.time()
+        return self.book
+
+    def _position(self, symbol, side):
+        for p in (yield from self._refresh()):
+            if p.get('symbol') == symbol and p.get('positionSide') == side:
+                return abs(float(p.get('positionAmt', 0)))
+        return 0.0
+
+    def _open(self, coins):
+        successful_trades = []
+        try:
+            for coin in coins:
+                symbol, side, leverage, amount_usdt, margin_type = coin['symbol'], coin['side'].upper(), int(coin['leverage']), float(coin['margin']), coin['margin_mode'].upper()
+                yield call(self.bn.set_leverage, symbol, leverage)
+                yield call(self.bn.set_margin_type, symbol, margin_type)
+                price = float((yield call(self.bn.price, symbol))['price'])
+                qty = yield call(self.bn.round_lot_size, symbol, amount_usdt / price)
+                order_side = 'BUY' if side == 'LONG' else 'SELL'
+                yield call(self.bn.order_market, symbol, order_side, qty, position_side=side)
+                successful_trades.append({'symbol': symbol, 'side': side})
+                # Pause between legs; the worker serves other accounts meanwhile.
+                yield 0.1
+        except Exception:
+            if successful_trades: yield from self._rollback(successful_trades)
+            raise
+        finally:
+            self.book_at = 0.0
+        return len(successful_trades)
+
+    def _rollback(self, trades):
+        print(f"Rolling back {len(trades)} trades...")
+        self.book_at = 0.0
+        for trade in trades:
+            try:
+                cleanup_side = 'SELL' if trade['side'] == 'LONG' else 'BUY'
+                amt = yield from self._position(trade['symbol'], trade['side'])
+                if amt > 0: yield call(self.bn.order_market, trade['symbol'], cleanup_side, amt, position_side=trade['side'])
+            except Exception as cleanup_e: print(f"Failed to rollback {trade['symbol']}: {cleanup_e}")
+        self.book_at = 0.0
+        return len(trades)
+
+    def _close(self, trades):
+        closed_count = 0
+        # One positionRisk call covers every trade in the request.
+        self.book_at = 0.0
+        for trade in trades:
+            try:
+                symbol, side = trade['symbol'], trade['side'].upper()
+                close_side = 'SELL' if side == 'LONG' else 'BUY'
+                amt = yield from self._position(symbol, side)
+                if amt > 0:
+                    yield call(self.bn.order_market, symbol, close_side, amt, position_side=side)
+                    closed_count += 1
+            except Exception as e:
+                print(f"Could not close trade for {trade.get('symbol')}: {e}")
+        self.book_at = 0.0
+        return closed_count
+
+    def _balance(self, _):
+        return (yield call(self.bn.futures_balance))
+
+    def _prepare(self, coins):
+        """Sets leverage and margin type for sliced legs and gathers the price and filters to size them."""
+        legs = []
+        for coin in coins:
+            symbol, side, leverage, amount_usdt, margin_type = coin['symbol'], coin['side'].upper(), int(coin['leverage']), float(coin['margin']), coin['margin_mode'].upper()
+            yield call(self.bn.set_leverage, symbol, leverage)
+            yield call(self.bn.set_margin_type, symbol, margin_type)
+            price = float((yield call(self.bn.price, symbol))['price'])
+            lot, min_notional = yield call(self.bn.symbol_filters, symbol)
+            legs.append({'symbol': symbol, 'side': side, 'leverage': leverage, 'margin': amount_usdt,
+                         'margin_type': margin_type, 'price': price, 'lot': lot, 'min_notional': min_notional})
+        return legs
+
+    def _child(self, parent):
+        # A parent cancelled (e.g. by a close) after its child was queued places nothing.
+        if parent.status != 'Executing': return 0.0
+        volume = 0.0
+        if parent.needs_volume():
+            try: volume = klines_volume((yield call(self.bn.klines, parent.symbol, '1m', 2)))
+            except Exception: pass
+        qty = parent.next_qty(volume)
+        if qty > 0:
+            yield call(self.bn.order_market, parent.symbol, parent.order_side, qty, position_side=parent.side)
+            self.book_at = 0.0
+        return qty
+
+    def _unwind(self, arg):
+        parent, qty = arg
+        self.book_at = 0.0
+        return (yield call(self.bn.order_market, parent.symbol, unwind_side(parent), float(f"{qty:.{parent.prec}f}"), position_side=parent.side))
+
+    def _rekey(self, client):
+        # Queued like any command, so the swap never happens under a running one.
+        self.bn, self.book_at = client, 0.0
+        return True
+
+    _handlers = {
+        'refresh': _refresh,
+        'open': _open,
+        'close': _close,
+        'rollback': _rollback,
+        'balance': _balance,
+        'prepare': _prepare,
+        'child': _child,
+        'unwind': _unwind,
+        'rekey': _rekey,
+    }
+
+class ActorRuntime:
+    """Maps active accounts to actors and runs their mailboxes on a small shared worker pool."""
+    def __init__(self, client_factory, workers=WORKERS):
+        self.client_factory = client_factory
+        self.workers = workers
+        self._actors = {}
+        self._lock = threading.Lock()
+        self._ready = queue.SimpleQueue()
+        self._threads = []
+        self._swept_at = time.time()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._timer_cv = threading.Condition()
+
+    def _ensure_started(self):
+        if self._threads: return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name=f'account-actor-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._run_timers, name='account-actor-timer', daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def _work(self):
+        while True:
+            actor = self._ready.get()
+            try:
+                actor._drain()
+            except Exception as e:
+                print(f"Actor error for account {actor.acc_id}: {e}")
+
+    def _wake_at(self, actor, delay):
+        """Parks an actor that is waiting on its budget or a pause; it stays scheduled meanwhile."""
+        if delay <= 0: return self._ready.put(actor)
+        with self._timer_cv:
+            heapq.heappush(self._timers, (time.time() + delay, next(self._timer_seq), actor))
+            self._timer_cv.notify()
+
+    def _run_timers(self):
+        while True:
+            with self._timer_cv:
+                while not self._timers or self._timers[0][0] > time.time():
+                    wait = self._timers[0][0] - time.time() if self._timers else None
+                    self._timer_cv.wait(timeout=wait)
+                _, _, actor = heapq.heappop(self._timers)
+            self._ready.put(actor)
+
+    def _get(self, acc):
+        # Caller holds self._lock.
+        fingerprint = (acc['api_key_enc'], acc['api_secret_enc'], bool(acc['testnet']))
+        self._ensure_started()
+        self._sweep()
+        actor = self._actors.get(acc['id'])
+        if actor is None:
+            actor = AccountActor(self, acc['id'], fingerprint, self.client_factory(acc, **CLIENT_OPTIONS))
+            self._actors[acc['id']] = actor
+        elif actor.fingerprint != fingerprint:
+            # Keys changed: the existing actor keeps the account and takes the new client in order.
+            client = self.client_factory(acc, **CLIENT_OPTIONS)
+            actor.fingerprint = fingerprint
+            actor.ask('rekey', client)
+        actor.evicted = False
+        actor.last_used = time.time()
+        return actor
+
+    def submit(self, acc, kind, arg=None):
+        """Queues a command on the account's actor and returns its Future."""
+        with self._lock:
+            return self._get(acc).ask(kind, arg)
+
+    def ask(self, acc, kind, arg=None, timeout=ASK_TIMEOUT):
+        return self.submit(acc, kind, arg).result(timeout=timeout)
+
+    def dispatch(self, kind, parent, arg=None):
+        """SliceScheduler hook: runs sliced children and their unwinds on the parent's account actor."""
+        return self.submit(parent.acc, kind, parent if kind == 'child' else (parent, arg))
+
+    def evict(self, acc_id):
+        """Drops an account's actor now if it is idle, otherwise once it goes idle."""
+        with self._lock:
+            actor = self._actors.get(acc_id)
+            if actor is None: return
+            if actor.idle(): del self._actors[acc_id]
+            else: actor.evicted = True
+
+    def _sweep(self):
+        t = time.time()
+        if t - self._swept_at < 60: return
+        self._swept_at = t
+        for acc_id, actor in list(self._actors.items()):
+            if (actor.evicted or t - actor.last_used > IDLE_TTL) and actor.idle():
+                del self._actors[acc_id]
@@ -6,12 +6,13 @@ MAIN_WS = 'wss://fstream.binance.com/ws'
 TEST_WS = 'wss://stream.binancefuture.com/ws'
 
 class BinanceUM:
-    def __init__(self, api_key: str, api_secret: str, testnet: bool = True):
+    def __init__(self, api_key: str, api_secret: str, testnet: bool = True, retries: int = 5, retry_delay: float = 5, timeout: float = 30):
         self.api_key = (api_key or '').strip()
         self.api_secret = (api_secret or '').strip().encode()
         self.base = TEST_BASE if testnet else MAIN_BASE
         self.ws_base = TEST_WS if testnet else MAIN_WS
         self._offset = None
+        self.retries, self.retry_delay, self.timeout = retries, retry_delay, timeout
         self.session = requests.Session()
         self.session.headers.update({'Content-Type': 'application/x-www-form-urlencoded'})
 
@@ -55,9 +56,9 @@ class BinanceUM:
         else:
             send_params = params
 
-        retries = 5 # FIXED: Increased to 5 attempts
-        delay = 5 # FIXED: Increased delay between attempts to 5 seconds
-        timeout_duration = 30 # FIXED: Increased timeout duration to 30 seconds
+        retries = self.retries # FIXED: Increased to 5 attempts by default
+        delay = self.retry_delay # FIXED: Increased delay between attempts to 5 seconds by default
+        timeout_duration = self.timeout # FIXED: Increased timeout duration to 30 seconds by default
 
         for i in range(retries):
             try:
@@ -95,6 +96,7 @@ class BinanceUM:
     def exchange_info(self): return self._request('GET','/fapi/v1/exchangeInfo')
     def price(self, symbol): return self._request('GET','/fapi/v1/ticker/price',{'symbol':symbol})
     def time(self): return self._request('GET','/fapi/v1/time')
+    def klines(self, symbol, interval='1m', limit=1): return self._request('GET','/fapi/v1/klines',{'symbol':symbol,'interval':interval,'limit':limit})
 
     # Signed
     def get_user_trades(self, symbol, start_time=None, limit=10):
@@ -11,7 +11,7 @@ USER = os.environ.get('DB_USER', 'polytradebot')
 PASSWORD = os.environ.get('DB_PASSWORD', 'V3E~9mk=4VKZ')
 DATABASE = os.environ.get('DB_NAME', 'polytradebot')
 PORT = int(os.environ.get('DB_PORT', 3306))
-SCHEMA_VERSION = 7 # Incremented version for user_id addition
+SCHEMA_VERSION = 8 # Incremented version for sliced execution progress on trades
 
 def now(): return int(time.time())
 
@@ -67,6 +67,20 @@ def init_db():
         try: cur.execute("ALTER TABLE templates ADD COLUMN user_id VARCHAR(255) NOT NULL;")
         except: pass
 
+        # Sliced (TWAP/POV) execution progress, tracked per parent order
+        try: cur.execute("ALTER TABLE trades ADD COLUMN exec_mode VARCHAR(20) DEFAULT 'market';")
+        except: pass
+        try: cur.execute("ALTER TABLE trades ADD COLUMN quantity DECIMAL(18, 8) DEFAULT 0.0;")
+        except: pass
+        try: cur.execute("ALTER TABLE trades ADD COLUMN filled_qty DECIMAL(18, 8) DEFAULT 0.0;")
+        except: pass
+        try: cur.execute("ALTER TABLE trades ADD COLUMN slices_total INT DEFAULT 1;")
+        except: pass
+        try: cur.execute("ALTER TABLE trades ADD COLUMN slices_done INT DEFAULT 0;")
+        except: pass
+        try: cur.execute("ALTER TABLE trades ADD COLUMN updated_at INT;")
+        except: pass
+
         # Recreate tables with user_id for a fresh install
         cur.execute("""CREATE TABLE IF NOT EXISTS bots (
             id INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
@@ -95,6 +109,12 @@ def init_db():
             status VARCHAR(50) DEFAULT 'Running',
             roi DECIMAL(18, 8) DEFAULT 0.0,
             pnl DECIMAL(18, 8) DEFAULT 0.0,
+            exec_mode VARCHAR(20) DEFAULT 'market',
+            quantity DECIMAL(18, 8) DEFAULT 0.0,
+            filled_qty DECIMAL(18, 8) DEFAULT 0.0,
+            slices_total INT DEFAULT 1,
+            slices_done INT DEFAULT 0,
+            updated_at INT,
             user_id VARCHAR(255) NOT NULL,
             FOREIGN KEY (bot_id) REFERENCES bots (id)
         ) ENGINE=InnoDB;""")
@@ -0,0 +1,48 @@
+import gzip, hashlib, json
+from flask import request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent as-is; compressing them costs more than it saves.
+MIN_COMPRESS = 512
+
+class Payload:
+    """A JSON body serialized once, with a content hash for its strong ETag and cached compressed variants."""
+    def __init__(self, obj):
+        self.body = json.dumps(obj, separators=(',', ':')).encode()
+        self.version = hashlib.blake2b(self.body, digest_size=12).hexdigest()
+        self._encoded = {}
+
+    def encoded(self, encoding):
+        if encoding not in self._encoded:
+            if encoding == 'br': self._encoded[encoding] = brotli.compress(self.body, quality=5)
+            else: self._encoded[encoding] = gzip.compress(self.body, compresslevel=6)
+        return self._encoded[encoding]
+
+    def precompress(self):
+        """Builds every variant up front, for payloads that are served many times."""
+        if brotli is not None: self.encoded('br')
+        self.encoded('gzip')
+        return self
+
+def _pick_encoding(size):
+    if size < MIN_COMPRESS: return None
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']: return 'br'
+    if accepted['gzip']: return 'gzip'
+    return None
+
+def send(payload, cache_control='private, no-cache', compress=True):
+    """Serves a Payload, answering 304 when the client already holds this version."""
+    encoding = _pick_encoding(len(payload.body)) if compress else None
+    # Each representation gets its own strong ETag, as RFC 9110 requires.
+    etag = payload.version + ('-' + encoding if encoding else '')
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    body = payload.encoded(encoding) if encoding else payload.body
+    if encoding: headers['Content-Encoding'] = encoding
+    return Response(body, status=200, headers=headers, mimetype='application/json')
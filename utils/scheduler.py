@@ -0,0 +1,280 @@
+import heapq, itertools, math, threading, time
+from collections import deque
+from utils.db import connect, now
+
+# Child orders placed per second across every account (Binance UM allows 300 orders / 10s).
+ORDER_RATE = 20.0
+ORDER_BURST = 40
+# Seconds between re-checks when the scheduler has nothing due.
+IDLE_WAIT = 5.0
+
+class RateBudget:
+    """Token bucket shared by every child order the scheduler places."""
+    def __init__(self, rate=ORDER_RATE, burst=ORDER_BURST):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n=1):
+        """Consume n tokens. Returns 0 on success, otherwise seconds until they are available."""
+        with self.lock:
+            t = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (t - self.stamp) * self.rate)
+            self.stamp = t
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0.0
+            return (n - self.tokens) / self.rate
+
+def _precision(step):
+    if step >= 1: return 0
+    return max(0, str(step)[::-1].find('.'))
+
+def _units(qty, step):
+    # Epsilon guards against float noise like 0.3/0.1 == 2.9999999999999996
+    return int(math.floor(qty / step + 1e-9))
+
+def _min_units(min_qty, step):
+    return max(1, int(math.ceil(min_qty / step - 1e-9)))
+
+def lot_slices(total_qty, slices, step, min_qty):
+    """Split total_qty into at most `slices` child quantities that are multiples of step and >= min_qty."""
+    units = _units(total_qty, step)
+    min_units = _min_units(min_qty, step)
+    if units < min_units: return []
+    n = max(1, min(int(slices), units // min_units))
+    base, extra = divmod(units, n)
+    prec = _precision(step)
+    return [float(f"{(base + (1 if i < extra else 0)) * step:.{prec}f}") for i in range(n)]
+
+class ParentOrder:
+    """One basket leg being worked as sliced child market orders."""
+    def __init__(self, acc, symbol, side, quantity, step, min_qty, mode='twap',
+                 slices=10, interval=30, participation=0.1, max_duration=3600, trade_id=None, bot_id=None):
+        self.trade_id, self.bot_id = trade_id, bot_id
+        # Account row; dispatch routes this parent's children through the account's actor.
+        self.acc, self.acc_id = acc, acc['id']
+        self.symbol, self.side = symbol, side
+        self.order_side = 'BUY' if side == 'LONG' else 'SELL'
+        self.step, self.min_qty, self.prec = step, min_qty, _precision(step)
+        self.min_units = _min_units(min_qty, step)
+        self.mode = mode
+        self.interval = max(1.0, float(interval))
+        self.participation = float(participation)
+        self.deadline = time.time() + float(max_duration)
+        if mode == 'twap':
+            self.children = lot_slices(quantity, slices, step, min_qty)
+        else:
+            self.children = None
+        self.quantity = float(f"{(sum(self.children) if self.children else _units(quantity, step) * step):.{self.prec}f}")
+        self.slices_total = len(self.children) if self.children else 0
+        self.filled = 0.0
+        self.slices_done = 0
+        self.status = 'Executing'
+        # Set once the basket failed: late fills are unwound as they land.
+        self.unwinding = False
+
+    @property
+    def remaining(self):
+        return float(f"{max(0.0, self.quantity - self.filled):.{self.prec}f}")
+
+    @property
+    def remaining_units(self):
+        return int(round(self.remaining / self.step))
+
+    def needs_volume(self):
+        return self.children is None and time.time() < self.deadline
+
+    def next_qty(self, volume=0.0):
+        if self.children is not None:
+            return self.children[self.slices_done]
+        # Participation of volume: a fraction of the last closed minute's traded base volume, scaled to the interval.
+        remaining = self.remaining_units
+        if time.time() >= self.deadline: return float(f"{remaining * self.step:.{self.prec}f}")
+        units = max(_units(volume * self.participation * self.interval / 60.0, self.step), self.min_units)
+        if remaining - units < self.min_units: units = remaining
+        return float(f"{min(units, remaining) * self.step:.{self.prec}f}")
+
+def klines_volume(klines):
+    # klines(limit=2) ends with the candle still forming; the one before it is the last closed minute.
+    try: return float(klines[-2][5])
+    except Exception: return 0.0
+
+def unwind_side(parent):
+    return 'SELL' if parent.side == 'LONG' else 'BUY'
+
+def _save_progress(parent):
+    try:
+        with connect() as con:
+            con.cursor().execute('UPDATE trades SET filled_qty=%s, slices_done=%s, slices_total=%s, status=%s, updated_at=%s WHERE id=%s',
+                                 (parent.filled, parent.slices_done, parent.slices_total, parent.status, now(), parent.trade_id))
+            con.commit()
+    except Exception as e:
+        print(f"Failed to save progress for trade {parent.trade_id}: {e}")
+
+def _save_bot_status(bot_id, status):
+    try:
+        with connect() as con:
+            con.cursor().execute('UPDATE bots SET status=%s WHERE id=%s', (status, bot_id))
+            con.commit()
+    except Exception as e:
+        print(f"Failed to save status for bot {bot_id}: {e}")
+
+def interrupt_stale():
+    """
+    Scheduler state lives in memory, so parents still Executing at startup were cut off
+    by a restart. They are marked Interrupted; filled_qty shows what is left open.
+    """
+    try:
+        with connect() as con:
+            cur = con.cursor()
+            cur.execute("UPDATE trades SET status='Interrupted', updated_at=%s WHERE status='Executing'", (now(),))
+            cur.execute("UPDATE bots SET status='Interrupted' WHERE status='Executing'")
+            con.commit()
+    except Exception as e:
+        print(f"Failed to mark interrupted sliced orders: {e}")
+
+class SliceScheduler:
+    """
+    Times every sliced parent order from a single thread. Due children sit in one timer
+    heap keyed by fire time and draw from a shared RateBudget. The exchange calls run
+    through `dispatch(kind, parent, arg=None) -> Future`, and their results come back to
+    this thread, which does all progress bookkeeping and DB writes.
+    """
+    def __init__(self, dispatch, budget=None):
+        self.dispatch = dispatch
+        self.budget = budget or RateBudget()
+        self._heap = []
+        self._done = deque()
+        self._seq = itertools.count()
+        self._cv = threading.Condition()
+        self._groups = {}
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive(): return
+        self._thread = threading.Thread(target=self._run, name='slice-scheduler', daemon=True)
+        self._thread.start()
+
+    def _push(self, due, parent):
+        with self._cv:
+            heapq.heappush(self._heap, (due, next(self._seq), parent))
+            self._cv.notify()
+
+    def submit(self, parents):
+        with self._cv:
+            t = time.time()
+            for p in parents:
+                self._groups.setdefault(p.bot_id, []).append(p)
+                heapq.heappush(self._heap, (t, next(self._seq), p))
+            self._cv.notify()
+        self._ensure_started()
+
+    def cancel(self, bot_id):
+        """Stops placing children for a basket. Already filled quantity is left open."""
+        with self._cv:
+            parents = self._groups.pop(bot_id, [])
+            cancelled = [p for p in parents if p.status == 'Executing']
+            for p in cancelled: p.status = 'Cancelled'
+        for p in cancelled: _save_progress(p)
+        if parents: _save_bot_status(bot_id, 'Cancelled')
+        return len(cancelled)
+
+    def cancel_account(self, acc_id, legs=None):
+        """
+        Cancels baskets with a parent still executing for the account. With `legs`, a set of
+        (symbol, side), only baskets working one of those legs are cancelled.
+        """
+        def hit(p):
+            return p.acc_id == acc_id and p.status == 'Executing' and (legs is None or (p.symbol, p.side) in legs)
+        with self._cv:
+            bot_ids = [b for b, ps in self._groups.items() if any(hit(p) for p in ps)]
+        return sum(self.cancel(b) for b in bot_ids)
+
+    def pending(self):
+        with self._cv:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._done and (not self._heap or self._heap[0][0] > time.time()):
+                    wait = self._heap[0][0] - time.time() if self._heap else IDLE_WAIT
+                    self._cv.wait(timeout=max(0.0, wait))
+                if self._done: parent, fut = self._done.popleft()
+                else: (_, _, parent), fut = heapq.heappop(self._heap), None
+            try:
+                if fut is None: self._fire(parent)
+                else: self._on_child(parent, fut)
+            except Exception as e:
+                print(f"Slice scheduler error on {parent.symbol}: {e}")
+
+    def _complete(self, parent, fut):
+        # Runs on whichever thread settled the child; hand the result to the scheduler thread.
+        with self._cv:
+            self._done.append((parent, fut))
+            self._cv.notify()
+
+    def _fire(self, parent):
+        with self._cv:
+            if parent.status != 'Executing': return
+        # POV children also spend a klines call.
+        wait = self.budget.take(1 if parent.children is not None else 2)
+        if wait:
+            self._push(time.time() + wait, parent)
+            return
+        try:
+            fut = self.dispatch('child', parent)
+        except Exception as e:
+            # e.g. the account's client could not be built; treat it like a failed child.
+            print(f"Could not dispatch child for {parent.symbol}: {e}")
+            return self._fail_group(parent)
+        fut.add_done_callback(lambda f: self._complete(parent, f))
+
+    def _on_child(self, parent, fut):
+        try:
+            qty = fut.result()
+        except Exception as e:
+            print(f"Child order failed for {parent.symbol}: {e}")
+            return self._fail_group(parent)
+        with self._cv:
+            if qty > 0:
+                parent.filled += qty
+                parent.slices_done += 1
+                if parent.children is None: parent.slices_total = parent.slices_done
+            late = parent.status != 'Executing'
+            unwind = late and parent.unwinding and qty > 0
+            done = not late and (qty <= 0 or parent.remaining_units < parent.min_units)
+            if done: parent.status = 'Running'
+            group_done = done and all(p.status != 'Executing' for p in self._groups.get(parent.bot_id, []))
+            if group_done: self._groups.pop(parent.bot_id, None)
+        # A child that lands after a cancel keeps its fill but not a new status.
+        if unwind: self._unwind(parent, qty)
+        _save_progress(parent)
+        if group_done: _save_bot_status(parent.bot_id, 'Running')
+        elif not late and not done: self._push(time.time() + parent.interval, parent)
+
+    def _unwind(self, parent, qty):
+        def report(f):
+            try: f.result()
+            except Exception as cleanup_e: print(f"Failed to rollback {parent.symbol}: {cleanup_e}")
+        try:
+            self.dispatch('unwind', parent, qty).add_done_callback(report)
+        except Exception as cleanup_e: print(f"Failed to rollback {parent.symbol}: {cleanup_e}")
+
+    def _fail_group(self, failed):
+        # Same policy as the unsliced submit path: unwind every leg of the basket.
+        with self._cv:
+            # Already cancelled or failed elsewhere: nothing left to roll back here.
+            if failed.status != 'Executing': return
+            group = self._groups.pop(failed.bot_id, [failed])
+            for p in group:
+                p.status = 'Failed' if p is failed else 'Cancelled'
+                p.unwinding = True
+        print(f"Rolling back {len(group)} sliced trades...")
+        for p in group:
+            if p.filled > 0: self._unwind(p, p.filled)
+            _save_progress(p)
+        _save_bot_status(failed.bot_id, 'Failed')